@@ -1,6 +1,21 @@
 #!/usr/bin/env python3
+import os
+import sys
+
 from setuptools import setup, find_packages
 
+# Opt-in native build of the extraction hot loop:
+#   pip install mypy && CLI_AGENT_LOGGER_MYPYC=1 pip install --no-build-isolation .
+# Without it (or without mypy in the build environment) the pure-Python module is used as-is.
+ext_modules = []
+if os.environ.get('CLI_AGENT_LOGGER_MYPYC') == '1':
+    try:
+        from mypyc.build import mypycify
+    except ImportError:
+        sys.stderr.write("warning: mypyc not found, installing the pure-Python extractor\n")
+    else:
+        ext_modules = mypycify(['src/extract_logs.py'])
+
 setup(
     name="cli-agent-logger",
     version="1.0.0",
@@ -8,10 +23,15 @@ setup(
     author="Claude",
     packages=find_packages(),
     install_requires=[],
+    extras_require={
+        'fast': ['orjson'],
+    },
     entry_points={
         'console_scripts': [
             'claude-with-logging=src.claude_session:main',
+            'cli-agent-extract=src.extract_logs:main',
         ],
     },
+    ext_modules=ext_modules,
     python_requires='>=3.6',
 )
\ No newline at end of file
@@ -0,0 +1,34 @@
+"""
+Small helpers shared by the logger, session and extraction modules
+"""
+
+import sys
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable
+
+# Maps path separators to '-' when deriving the global logs directory name
+DIR_SANITIZER = str.maketrans({'/': '-', ':': '-', ' ': '-'})
+
+
+@lru_cache(maxsize=32)
+def derive_global_dir(key: str) -> Path:
+    """Global logs directory under ~/.claude/projects for a cwd path or target netloc"""
+    return Path.home() / ".claude" / "projects" / key.translate(DIR_SANITIZER)
+
+
+def emit(lines: Iterable[str]) -> None:
+    """Write a block of status lines to stdout in one call"""
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+
+def file_timestamp() -> str:
+    """Local time as YYYYmmdd_HHMMSS_ffffff for global JSON file names
+
+    The microseconds keep files written within the same second apart.
+    """
+    now = time.time()
+    seconds = time.strftime("%Y%m%d_%H%M%S", time.localtime(now))
+    return f"{seconds}_{int(now % 1 * 1e6):06d}"
@@ -4,57 +4,143 @@ Integrated command to run Claude CLI with API logging
 """
 
 import argparse
+import json
 import os
 import shutil
+import signal
 import socket
 import subprocess
 import sys
 import time
 from pathlib import Path
+from typing import Set
 from urllib.parse import urlparse
 
-from .mitm_logger import MitmLogger
-from .extract_logs import extract_flows_to_json
+from ._util import derive_global_dir, emit, file_timestamp
 
+# Marks an environment variable that was unset before the session started
+_MISSING = object()
+
+# Home directory does not change during the process lifetime
+_HOME = str(Path.home())
+
+# Records the persistent mitmweb started with --daemon
+DAEMON_FILE = Path(os.path.join(_HOME, ".claude", "cli-agent-logger", "daemon.json"))
+
+# mitmweb addon loaded into the persistent logger for per-session captures
+_SESSION_CAPTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "session_capture.py")
+
+# Static mitmweb options; only mode and ports vary per session
+_MITMWEB_OPTIONS = (
+    "--set", "save_stream_file=cli_agent_requests.mitm",
+    # Bodies above this are streamed through instead of buffered (avoids
+    # mitmproxy's quadratic buffer slicing on huge payloads) but are then
+    # not saved to the stream file. 32m matches the API request size cap.
+    "--set", "stream_large_bodies=32m",
+    "--set", "body_size_limit=500m",
+    "--set", "connection_timeout=300",
+    "--set", "read_timeout=300",
+    "--set", "response_timeout=600",
+    "--set", "keep_alive_timeout=300",
+    "--set", "http2_ping_keepalive=60",
+    "--set", "upstream_cert=false",
+    # The Anthropic API streams over SSE, not WebSockets
+    "--set", "stream_websockets=false",
+    # Keep upstream compression; bodies are decoded on demand at extraction
+    "--set", "anticomp=false",
+)
+
+_MITMWEB_DEBUG_OPTIONS = (
+    "--set", "proxy_debug=true",
+    "--set", "web_debug=true",
+    "--set", "termlog_verbosity=debug",
+)
 
 class ClaudeSession:
+    # Global log directories already created by this process
+    _KNOWN_DIRS: Set[str] = set()
+
     def __init__(self, base_url, port=8000, logs_dir="cli-agent-logs", debug=False):
         self.base_url = base_url
+        # Split base_url into proxy target and API path once
+        parsed = urlparse(base_url)
+        self.target = f"{parsed.scheme}://{parsed.netloc}"
+        self.path = parsed.path.lstrip("/") if parsed.path else ""
         self.port = port
         self.logs_dir = Path(logs_dir)
         self.debug = debug
-        self.logger = None
-        self.original_env = {}
+        self.logger_process = None
+        self.claude_pid = None
+        self.daemon = None
+        # Set when attached to a persistent logger, which captures this session separately
+        self.session_id = None
+        self.debug_log = None
+        self.original_base_url = None
 
     def find_available_port(self, start_port=8000):
         """Find an available port starting from start_port"""
-        port = start_port
-        while port < start_port + 100:  # Try 100 ports max
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    result = s.connect_ex(('localhost', port))
-                    if result != 0:  # Port is available
-                        return port
-                    port += 1
-            except Exception:
-                port += 1
+        # Serial on purpose: a bind probe never blocks, so probing on a thread
+        # pool only adds thread startup and scheduling cost
+        for port in range(start_port, start_port + 100):  # Try 100 ports max
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                try:
+                    s.bind(('localhost', port))
+                except OSError:
+                    continue  # Port is in use
+                return port
         return None
         
-    def parse_url(self, url):
-        """Parse URL to extract target and path"""
-        parsed = urlparse(url)
-        target = f"{parsed.scheme}://{parsed.netloc}"
-        path = parsed.path.lstrip("/") if parsed.path else ""
-        return target, path
-
-    def start_logger(self, target_url):
+    @staticmethod
+    def find_daemon(target_url=None):
+        """Return the persistent logger info if one is alive (for target_url, if given)"""
+        try:
+            with open(DAEMON_FILE) as f:
+                info = json.load(f)
+            os.kill(info['pid'], 0)  # Raises if the process is gone
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if target_url is not None and info.get('target') != target_url:
+            return None
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            if s.connect_ex(('localhost', info['port'])) != 0:
+                return None
+        return info
+
+    def start_logger(self, target_url, daemon=False):
         """Start the logger in background terminal"""
+        # Reuse a persistent logger for the same target if one is running
+        if not daemon:
+            info = self.find_daemon(target_url)
+            if info:
+                ignored = []
+                if self.port != info['port']:
+                    ignored.append(f"--port {self.port}")
+                if str(self.logs_dir.resolve()) != info['logs_dir']:
+                    ignored.append(f"--logs-dir {self.logs_dir}")
+                if self.debug:
+                    ignored.append("--debug")
+                self.daemon = info
+                self.session_id = f"{file_timestamp()}_{os.getpid()}"
+                self.port = info['port']
+                self.logs_dir = Path(info['logs_dir'])
+                lines = [
+                    f"♻️  Reusing persistent API logger (pid {info['pid']})",
+                    f"   Target: {target_url}",
+                    f"   Proxy: http://localhost:{self.port}",
+                    f"   Logs: {self.logs_dir}/",
+                ]
+                if ignored:
+                    lines.append(f"⚠️  Ignoring {', '.join(ignored)}: the persistent logger keeps its own settings")
+                emit(lines)
+                return info
+
         # Ensure logs directory exists (absolute path)
         self.logs_dir = self.logs_dir.resolve()
         self.logs_dir.mkdir(parents=True, exist_ok=True)
         
         # Check if port is available
-        original_port = self.port
         available_port = self.find_available_port(self.port)
         
         if available_port is None:
@@ -65,12 +151,15 @@ class ClaudeSession:
             print(f"⚠️  Port {self.port} is occupied, using port {available_port} instead")
             self.port = available_port
         
-        print(f"🚀 Starting API logger in background...")
-        print(f"   Target: {target_url}")
-        print(f"   Proxy: http://localhost:{self.port}")
-        print(f"   Logs: {self.logs_dir}/")
+        lines = [
+            "🚀 Starting API logger in background...",
+            f"   Target: {target_url}",
+            f"   Proxy: http://localhost:{self.port}",
+            f"   Logs: {self.logs_dir}/",
+        ]
         if self.debug:
-            print("🐛 Debug mode enabled - verbose logging active")
+            lines.append("🐛 Debug mode enabled - verbose logging active")
+        emit(lines)
 
         # Start mitmweb directly in background terminal
         cmd = [
@@ -79,180 +168,276 @@ class ClaudeSession:
             "--listen-port", str(self.port),
             "--web-host", "localhost",
             "--web-port", str(self.port + 1000),
-            "--set", f"save_stream_file=cli_agent_requests.mitm",
-            "--set", "stream_large_bodies=100m",
-            "--set", "body_size_limit=500m",
-            "--set", "connection_timeout=300",
-            "--set", "read_timeout=300",
-            "--set", "response_timeout=600",
-            "--set", "keep_alive_timeout=300",
-            "--set", "http2_ping_keepalive=60",
-            "--set", "upstream_cert=false",
-            "--set", "stream_websockets=true",
-            "--set", "anticomp=true"
+            *_MITMWEB_OPTIONS
         ]
-        
+
+        if daemon:
+            cmd.extend(("-s", _SESSION_CAPTURE))
+
         # Add debug settings if debug mode is enabled
         if self.debug:
-            cmd.extend([
-                "--set", "proxy_debug=true",
-                "--set", "web_debug=true",
-                "--set", "termlog_verbosity=debug"
-            ])
-        
+            cmd.extend(_MITMWEB_DEBUG_OPTIONS)
+
         # Start logger process with correct working directory
         try:
             debug_log_file = self.logs_dir / "mitm_debug.log"
+            env = None
+            output = subprocess.DEVNULL
             if self.debug:
-                # In debug mode, redirect ALL output to file using shell
+                # In debug mode, redirect ALL output to file
                 env = os.environ.copy()
                 env['MITMPROXY_DEBUG'] = '1'
-                
-                # Use shell to redirect both stdout and stderr
-                cmd_str = ' '.join(f'"{arg}"' for arg in cmd) + f' >"{debug_log_file}" 2>&1'
-                self.logger_process = subprocess.Popen(
-                    cmd_str,
-                    shell=True,
-                    env=env,
-                    cwd=self.logs_dir,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL
-                )
+                self.debug_log = open(debug_log_file, 'wb', buffering=0)
+                output = self.debug_log
+
+            self.logger_process = subprocess.Popen(
+                cmd,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                stdin=subprocess.DEVNULL,
+                cwd=self.logs_dir,
+                env=env,
+                # Own process group: cleanup can signal exactly mitmweb, and a
+                # daemon outlives this process and its terminal
+                start_new_session=True
+            )
+            if self.debug:
                 print(f"🐛 Debug mode enabled - logs written to: {debug_log_file}")
-            else:
-                # In normal mode, suppress output
-                self.logger_process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    stdin=subprocess.DEVNULL,
-                    cwd=self.logs_dir
-                )
             
-            # Wait for logger to start
-            time.sleep(3)
+            # Wait for logger to start accepting connections
+            if not self.wait_for_logger():
+                print(f"⚠️  Logger not reachable on port {self.port} yet, continuing anyway")
             return self.logger_process
             
         except Exception as e:
             print(f"❌ Failed to start logger: {e}")
             return None
 
+    def wait_for_logger(self, timeout=3.0, interval=0.05):
+        """Poll the proxy port until mitmweb accepts connections or timeout expires"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                if s.connect_ex(('localhost', self.port)) == 0:
+                    return True
+            if self.logger_process.poll() is not None:
+                # Logger exited before it came up
+                return False
+            time.sleep(interval)
+        return False
+
     def setup_environment(self, path):
         """Set up environment variables"""
         local_url = f"http://localhost:{self.port}"
+        if self.session_id:
+            # Routes this session's flows to its own capture (see session_capture.py)
+            local_url = f"{local_url}/_session/{self.session_id}"
         if path:
             local_url = f"{local_url}/{path}"
 
         print(f"🌍 Setting ANTHROPIC_BASE_URL={local_url}")
-        self.original_env = os.environ.copy()
+        self.original_base_url = os.environ.get("ANTHROPIC_BASE_URL", _MISSING)
         os.environ["ANTHROPIC_BASE_URL"] = local_url
 
     def run_claude_cli(self):
         """Run Claude CLI"""
-        print("🤖 Starting Claude CLI...")
-        print("   Press Ctrl+D or type 'exit' to quit")
-        print("=" * 50)
+        emit([
+            "🤖 Starting Claude CLI...",
+            "   Press Ctrl+D or type 'exit' to quit",
+            "=" * 50,
+        ])
 
-        try:
-            subprocess.run(["claude"], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"❌ Claude CLI error: {e}")
-            return False
-        except FileNotFoundError:
+        claude = shutil.which("claude")
+        if claude is None:
             print("❌ Claude CLI not found. Please install it first.")
             return False
-        return True
+
+        pid = self.claude_pid = os.fork()
+        if pid == 0:
+            # Child: become the Claude CLI
+            try:
+                os.execv(claude, ["claude"])
+            finally:
+                os._exit(127)
+
+        # Parent: let Claude own Ctrl+C so teardown always runs afterwards
+        previous_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            _, status = os.waitpid(pid, 0)
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+        self.claude_pid = None
+
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            return True
+        if os.WIFSIGNALED(status):
+            print(f"❌ Claude CLI error: terminated by signal {os.WTERMSIG(status)}")
+        else:
+            print(f"❌ Claude CLI error: exit status {os.WEXITSTATUS(status)}")
+        return False
 
     def cleanup(self):
         """Clean up environment and stop logger"""
-        # Restore original environment
-        if self.original_env:
-            os.environ.clear()
-            os.environ.update(self.original_env)
+        # Restore original environment (only ANTHROPIC_BASE_URL is changed)
+        if self.original_base_url is _MISSING:
+            os.environ.pop("ANTHROPIC_BASE_URL", None)
+        elif self.original_base_url is not None:
+            os.environ["ANTHROPIC_BASE_URL"] = self.original_base_url
+        self.original_base_url = None
 
-
-        # Stop logger
-        print("🛑 Stopping logger...")
-        if hasattr(self, 'logger_process') and self.logger_process:
+        # Stop logger (a reused persistent logger keeps running)
+        if self.daemon:
+            print("♻️  Leaving persistent logger running")
+        else:
+            print("🛑 Stopping logger...")
+        if self.logger_process:
+            pgid = self.logger_process.pid
             try:
-                self.logger_process.terminate()
+                # SIGINT lets mitmproxy flush the stream file before exiting
+                os.killpg(pgid, signal.SIGINT)
                 self.logger_process.wait(timeout=5)
                 print("✅ Logger terminated successfully")
             except subprocess.TimeoutExpired:
-                self.logger_process.kill()
+                os.killpg(pgid, signal.SIGKILL)
                 self.logger_process.wait()
                 print("⚠️  Logger force-killed")
+            except ProcessLookupError:
+                # Already exited; reap it
+                self.logger_process.wait()
+                print("✅ Logger terminated successfully")
             except Exception as e:
                 print(f"❌ Error terminating logger: {e}")
-                # Fallback: kill any remaining mitmweb processes
-                subprocess.run(["pkill", "-f", "mitmweb.*reverse.*"], check=False)
-                subprocess.run(["pkill", "-f", "mitmproxy"], check=False)
+
+        if self.debug_log:
+            self.debug_log.close()
+            self.debug_log = None
 
     def extract_logs(self):
         """Extract logs to global directory based on target URL"""
         print("📝 Extracting logs to global directory...")
 
-        # Find the latest .mitm file in local directory
-        mitm_files = list(self.logs_dir.glob("*.mitm"))
-        if not mitm_files:
-            # Also check if there's a cli_agent_requests.mitm file
-            expected_file = self.logs_dir / "cli_agent_requests.mitm"
-            if expected_file.exists():
-                latest_mitm = expected_file
-            else:
-                print("ℹ️  No mitm files found")
+        if self.session_id:
+            # The persistent logger keeps running; read this session's own capture,
+            # which is flushed after every flow, not the shared buffered one
+            latest_mitm = self.logs_dir / "sessions" / f"{self.session_id}.mitm"
+            if not latest_mitm.exists():
+                print("ℹ️  No requests captured in this session")
                 return None
         else:
-            latest_mitm = max(mitm_files, key=lambda x: x.stat().st_mtime if x.exists() else 0)
-        
-        # Ensure file is written and closed
-        time.sleep(1)
-        
+            # Find the latest .mitm file in local directory (single scandir pass)
+            latest_path = None
+            latest_mtime = -1
+            try:
+                with os.scandir(self.logs_dir) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.mitm') and entry.is_file():
+                            mtime = entry.stat().st_mtime
+                            if mtime > latest_mtime:
+                                latest_mtime = mtime
+                                latest_path = entry.path
+            except FileNotFoundError:
+                pass
+
+            if latest_path is None:
+                print("ℹ️  No mitm files found")
+                return None
+            latest_mitm = Path(latest_path)
+
         # Create global directory based on current working directory path
-        current_dir = Path.cwd()
-        dir_name = str(current_dir).replace('/', '-').replace(':', '-').replace(' ', '-')
-        global_logs_dir = Path.home() / ".claude" / "projects" / dir_name
-        global_logs_dir.mkdir(parents=True, exist_ok=True)
+        global_logs_dir = derive_global_dir(os.getcwd())
+        key = str(global_logs_dir)
+        if key not in self._KNOWN_DIRS:
+            global_logs_dir.mkdir(parents=True, exist_ok=True)
+            self._KNOWN_DIRS.add(key)
         
         # Use the extract function to generate JSON in global directory
         try:
+            # Imported here so mitmproxy only loads when extraction runs
+            from .extract_logs import extract_flows_to_json
+
+            # Merged JSON goes straight to its timestamped name in the global directory
+            global_json = global_logs_dir / f"cli_agent_requests_{file_timestamp()}.json"
             success = extract_flows_to_json(
                 str(latest_mitm),
-                output_file=str(global_logs_dir / "cli_agent_requests_original.json")
+                output_file=str(global_logs_dir / "cli_agent_requests_original.json"),
+                merged_output_file=str(global_json)
             )
             if success:
-                # Copy merged JSON file to global directory with timestamp
-                from datetime import datetime
-                
-                base_name = str(latest_mitm).replace('.mitm', '')
-                merged_json_file = f"{base_name}_merged.json"
-                
-                local_json = Path(merged_json_file)
-                if local_json.exists():
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    global_json = global_logs_dir / f"cli_agent_requests_{timestamp}.json"
-                    shutil.copy2(local_json, global_json)
-                    print("✅ Logs extracted successfully!")
-                    print(f"   📁 Global directory: {global_logs_dir}")
-                    print(f"   📄 Merged JSON: {global_json}")
-                else:
-                    print("❌ Merged JSON file not found")
+                emit([
+                    "✅ Logs extracted successfully!",
+                    f"   📁 Global directory: {global_logs_dir}",
+                    f"   📄 Merged JSON: {global_json}",
+                ])
             else:
                 print("❌ Failed to extract logs")
         except Exception as e:
             print(f"❌ Error extracting logs: {e}")
 
+    def start_daemon(self):
+        """Start a persistent logger that later sessions reuse"""
+        if self.find_daemon(self.target):
+            print(f"ℹ️  Persistent logger already running, see {DAEMON_FILE}")
+            return False
+
+        if not self.start_logger(self.target, daemon=True):
+            return False
+
+        DAEMON_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(DAEMON_FILE, 'w') as f:
+            json.dump({
+                'pid': self.logger_process.pid,
+                'port': self.port,
+                'target': self.target,
+                'logs_dir': str(self.logs_dir)
+            }, f)
+        emit([
+            f"✅ Persistent logger started (pid {self.logger_process.pid})",
+            "   Stop it with: claude-with-logging --stop-daemon",
+        ])
+        return True
+
+    @staticmethod
+    def stop_daemon():
+        """Stop the persistent logger if one is running"""
+        # A stale daemon file may name a pid that now belongs to another process
+        info = ClaudeSession.find_daemon()
+        if info is None:
+            print("ℹ️  No persistent logger running")
+        else:
+            try:
+                os.killpg(info['pid'], signal.SIGINT)
+                print(f"🛑 Stopped persistent logger (pid {info['pid']})")
+            except OSError:
+                print("ℹ️  No persistent logger running")
+        try:
+            DAEMON_FILE.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _on_exit_signal(self, signum, frame):
+        """Forward SIGTERM/SIGHUP to Claude, then unwind so run() tears down"""
+        if signum == signal.SIGHUP:
+            # The terminal is gone; writing status lines to it would fail
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+        if self.claude_pid:
+            try:
+                os.kill(self.claude_pid, signum)
+            except ProcessLookupError:
+                pass
+        raise SystemExit(128 + signum)
+
     def run(self):
         """Run complete session"""
+        # mitmweb runs in its own session, so it is not stopped along with
+        # this process; teardown has to run on these signals too
+        exit_signals = (signal.SIGTERM, signal.SIGHUP)
+        previous_handlers = [signal.signal(sig, self._on_exit_signal) for sig in exit_signals]
         try:
-            # Parse URL
-            target, path = self.parse_url(self.base_url)
-
             # Start logger
-            logger_proc = self.start_logger(target)
+            self.start_logger(self.target)
 
             # Setup environment
-            self.setup_environment(path)
+            self.setup_environment(self.path)
 
             # Run Claude CLI
             success = self.run_claude_cli()
@@ -260,9 +445,15 @@ class ClaudeSession:
             return success
 
         finally:
-            # Always cleanup
-            self.cleanup()
-            self.extract_logs()
+            # Always cleanup, without being interrupted by a repeated signal
+            for sig in exit_signals:
+                signal.signal(sig, signal.SIG_IGN)
+            try:
+                self.cleanup()
+                self.extract_logs()
+            finally:
+                for sig, handler in zip(exit_signals, previous_handlers):
+                    signal.signal(sig, handler)
 
 
 def main():
@@ -281,9 +472,19 @@ def main():
     parser.add_argument(
         "--debug", action="store_true", help="Enable debug mode with verbose logging"
     )
+    parser.add_argument(
+        "--daemon", action="store_true", help="Start a persistent logger reused by later sessions"
+    )
+    parser.add_argument(
+        "--stop-daemon", action="store_true", help="Stop the persistent logger"
+    )
 
     args = parser.parse_args()
 
+    if args.stop_daemon:
+        ClaudeSession.stop_daemon()
+        return
+
     # Use environment variable as fallback
     base_url = args.base_url or os.environ.get(
         "ANTHROPIC_BASE_URL", "https://api.moonshot.cn/anthropic"
@@ -295,6 +496,11 @@ def main():
 
     session = ClaudeSession(base_url=base_url, port=args.port, logs_dir=args.logs_dir, debug=args.debug)
 
+    if args.daemon:
+        if not session.start_daemon():
+            sys.exit(1)
+        return
+
     session.run()
 
 
@@ -5,6 +5,7 @@ CLI for moonshot-api-logger
 
 import argparse
 import os
+import sys
 
 from .mitm_logger import MitmLogger
 
@@ -38,14 +39,24 @@ Examples:
         default='cli-agent-logs',
         help='Directory to save logs (default: cli-agent-logs)'
     )
+    parser.add_argument(
+        '--live-extract',
+        action='store_true',
+        help='Stream flows through a FIFO into JSON instead of a .mitm file'
+    )
     
     args = parser.parse_args()
     
     # Change to current working directory so logs are saved where command is run
     os.chdir(os.getcwd())
 
-    logger = MitmLogger(host=args.host, port=args.port, logs_dir=args.logs_dir)
-    logger.start()
+    logger = MitmLogger(host=args.host, port=args.port, logs_dir=args.logs_dir, live_extract=args.live_extract)
+    if args.live_extract:
+        # The FIFO's reader lives in this process, so stay up until mitmweb exits
+        if not logger.run():
+            sys.exit(1)
+    else:
+        logger.start()
 
 
 
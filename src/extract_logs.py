@@ -8,8 +8,14 @@ import json
 import os
 import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, redirect_stdout
 from datetime import datetime
+from io import StringIO
 from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from ._util import derive_global_dir, file_timestamp
 
 try:
     from mitmproxy import io
@@ -18,78 +24,224 @@ except ImportError:
     print("mitmproxy not found. Install with: pip install mitmproxy")
     sys.exit(1)
 
+# orjson is optional; fall back to the stdlib json module when missing
+try:
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
 
-def extract_flows_to_json(mitm_file, output_file=None, merge_streaming=True):
-    """Convert mitmweb flow file to JSON with both merged and unmerged options"""
-    # Ensure output directory exists if output_file is specified
-    if output_file:
-        output_path = Path(output_file)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-    
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    """Parse JSON from str or bytes"""
+    if _HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize obj to UTF-8 JSON bytes, stringifying unknown types"""
+    if _HAS_ORJSON:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option, default=str)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False, default=str).encode('utf-8')
+
+
+# Large sequential reads/writes of flow and JSON files
+_IO_BUFFER_SIZE = 1 << 20
+
+# SSE framing tokens
+_DATA_PREFIX = b'data:'
+_DONE = b'[DONE]'
+
+# Text deltas make up almost every SSE chunk; their text is located directly
+_DELTA_TYPE = b'"type":"content_block_delta"'
+_TEXT_KEY = b'"text":"'
+_BACKSLASH = ord('\\')
+
+
+def _delta_text(data: bytes) -> Optional[str]:
+    """Return delta.text of a content_block_delta payload, or None to fall back to a full parse"""
+    start = data.find(_TEXT_KEY)
+    if start == -1:
+        return None
+    start += len(_TEXT_KEY)
+
+    # Find the closing quote, skipping quotes escaped by an odd run of backslashes
+    end = data.find(b'"', start)
+    while end != -1:
+        backslashes = 0
+        while data[end - 1 - backslashes] == _BACKSLASH:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+        end = data.find(b'"', end + 1)
+    if end == -1:
+        return None
+
+    text = data[start:end]
+    if _BACKSLASH in text:
+        decoded: str = _json_loads(b'"' + text + b'"')
+        return decoded
+    return text.decode('utf-8', errors='replace')
+
+
+class _JsonArrayWriter:
+    """Write a JSON array to path, and to any copies, one element at a time
+
+    Output goes to temporary files that replace their targets on success, so
+    an existing file is only overwritten once at least one element was written.
+    The temporary names carry the pid, so concurrent writers do not collide.
+    """
+
+    def __init__(self, path: str, indent: bool = False, copies: Sequence[str] = ()) -> None:
+        self.paths = [path, *copies]
+        self.indent = indent
+        self.count = 0
+        self.files: List[BinaryIO] = []
+        try:
+            for target in self.paths:
+                self.files.append(open(f"{target}.{os.getpid()}.tmp", 'wb', buffering=_IO_BUFFER_SIZE))
+        except OSError:
+            self._discard()
+            raise
+
+    def add(self, obj: Any) -> None:
+        data = _json_dumps(obj, indent=self.indent)
+        if self.indent:
+            # Nest the element one level inside the array
+            data = b'  ' + data.replace(b'\n', b'\n  ')
+        separator = b'[\n' if self.count == 0 else b',\n'
+        for file in self.files:
+            file.write(separator)
+            file.write(data)
+        self.count += 1
+
+    def _discard(self) -> None:
+        for file in self.files:
+            file.close()
+            os.unlink(file.name)
+
+    def __enter__(self) -> '_JsonArrayWriter':
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        if exc_type is None and self.count:
+            for target, file in zip(self.paths, self.files):
+                file.write(b'\n]')
+                file.close()
+                os.replace(file.name, target)
+        else:
+            self._discard()
+
+
+def extract_flows_to_json(mitm_file: str, output_file: Optional[str] = None,
+                          merge_streaming: bool = True, pretty: bool = False,
+                          include_headers: bool = False, fmt: str = 'both',
+                          merged_copies: Sequence[str] = (),
+                          merged_output_file: Optional[str] = None) -> bool:
+    """Convert mitmweb flow file to JSON with both merged and unmerged options
+
+    fmt selects which files are written: 'original', 'merged' or 'both'.
+    Output is compact unless pretty is set, which indents it for reading.
+    Response headers are only kept for unmerged responses when include_headers is set.
+    output_file and merged_output_file override the default output paths.
+    The merged JSON is also written to every path in merged_copies in the same pass.
+    """
     if not os.path.exists(mitm_file):
         print(f"❌ File not found: {mitm_file}")
         return False
     
-    flows_original = []
-    flows_merged = []
+    # Output files for both formats
+    base_name = mitm_file.replace('.mitm', '')
+    original_file = output_file or f"{base_name}_original.json"
+    merged_file = merged_output_file or f"{base_name}_merged.json"
+    
+    write_original = fmt in ('original', 'both')
+    write_merged = fmt in ('merged', 'both')
+    
+    # Ensure directories exist for output files
+    if write_original:
+        Path(original_file).parent.mkdir(parents=True, exist_ok=True)
+    if write_merged:
+        for target in (merged_file, *merged_copies):
+            Path(target).parent.mkdir(parents=True, exist_ok=True)
+    
+    # Flows are written out as they are read, so memory stays flat
+    count = 0
+    fromtimestamp = datetime.fromtimestamp
     
     try:
-        with open(mitm_file, 'rb') as f:
+        with open(mitm_file, 'rb', buffering=_IO_BUFFER_SIZE) as f, ExitStack() as outputs:
+            out_original: Optional[_JsonArrayWriter] = None
+            out_merged: Optional[_JsonArrayWriter] = None
+            if write_original:
+                out_original = outputs.enter_context(_JsonArrayWriter(original_file, indent=pretty))
+            if write_merged:
+                out_merged = outputs.enter_context(_JsonArrayWriter(merged_file, indent=pretty, copies=merged_copies))
             flow_reader = io.FlowReader(f)
             
             for flow in flow_reader.stream():
-                if hasattr(flow, 'request') and hasattr(flow, 'response') and flow.response is not None:
+                if isinstance(flow, HTTPFlow) and flow.response is not None:
                     # Extract request details
-                    request_body = flow.request.get_text() if flow.request and flow.request.content else None
-                    response_body = flow.response.get_text() if flow.response and flow.response.content else None
+                    # Decoded (Content-Encoding) body bytes, fetched once per flow
+                    response_bytes = flow.response.content
+                    response_body = flow.response.get_text() if response_bytes else None
                     
                     # Original (unmerged) response
-                    original_response = {
-                        'status_code': flow.response.status_code if flow.response else None,
-                        'headers': dict(flow.response.headers) if flow.response and hasattr(flow.response, 'headers') else {},
+                    original_response: Dict[str, Any] = {
+                        'status_code': flow.response.status_code,
                         'response_body': response_body,
-                        'size': len(flow.response.content) if flow.response and flow.response.content else 0,
-                        'is_streaming': 'data: ' in (response_body or '')
+                        'size': len(response_bytes) if response_bytes else 0,
+                        'is_streaming': b'data: ' in (response_bytes or b'')
                     }
+                    if include_headers:
+                        original_response['headers'] = dict(flow.response.headers)
                     
-                    # Merged response (if applicable)
-                    merged_response = original_response.copy()
-                    merged_body = response_body
+                    # Merged response (if applicable); falls back to original_response
+                    merged_response: Optional[Dict[str, Any]] = None
                     
-                    if response_body and 'data:' in response_body and merge_streaming:
-                        lines = response_body.strip().split('\n')
-                        merged_content = ""
-                        full_response = None
+                    if write_merged and response_bytes and merge_streaming and _DATA_PREFIX in response_bytes:
+                        merged_parts: List[str] = []
+                        full_response: Optional[Dict[str, Any]] = None
                         
-                        for line in lines:
-                            line = line.strip()
-                            if line.startswith('data:'):
+                        # splitlines() accepts every SSE line ending (\n, \r\n and \r)
+                        for line in response_bytes.splitlines():
+                            if line.startswith(_DATA_PREFIX):
                                 try:
                                     data_str = line[5:].strip()
-                                    if data_str == '[DONE]':
+                                    if data_str == _DONE:
                                         continue
+
+                                    if _DELTA_TYPE in data_str:
+                                        delta_content = _delta_text(data_str)
+                                        if delta_content is not None:
+                                            merged_parts.append(delta_content)
+                                            continue
+
+                                    chunk = _json_loads(data_str)
                                     
-                                    chunk = json.loads(data_str)
-                                    
-                                    # Handle different message types
-                                    if chunk.get('type') == 'message_start':
-                                        full_response = chunk.get('message', {})
-                                    elif chunk.get('type') == 'content_block_start':
+                                    # Handle different message types; a missing
+                                    # field raises KeyError and skips the chunk
+                                    chunk_type = chunk['type']
+                                    if chunk_type == 'message_start':
+                                        full_response = chunk['message']
+                                    elif chunk_type == 'content_block_start':
                                         pass  # Initialize content if needed
-                                    elif chunk.get('type') == 'content_block_delta':
-                                        delta_content = chunk.get('delta', {}).get('text', '')
-                                        merged_content += delta_content
-                                    elif chunk.get('type') == 'message_delta':
+                                    elif chunk_type == 'content_block_delta':
+                                        merged_parts.append(chunk['delta']['text'])
+                                    elif chunk_type == 'message_delta':
                                         # Update usage tokens from final message_delta
-                                        delta_usage = chunk.get('usage', {})
-                                        if 'output_tokens' in delta_usage:
-                                            final_output_tokens = delta_usage['output_tokens']
-                                            if full_response and 'usage' in full_response:
-                                                full_response['usage']['output_tokens'] = final_output_tokens
+                                        final_output_tokens = chunk['usage']['output_tokens']
+                                        if full_response and 'usage' in full_response:
+                                            full_response['usage']['output_tokens'] = final_output_tokens
                                 
-                                except (json.JSONDecodeError, KeyError):
+                                except (ValueError, KeyError):
                                     continue
                         
+                        merged_content = "".join(merged_parts)
                         if full_response and merged_content:
                             # Build merged response with proper structure
                             merged_response = {
@@ -104,82 +256,60 @@ def extract_flows_to_json(mitm_file, output_file=None, merge_streaming=True):
                                 'stop_reason': 'end_turn',
                                 'usage': full_response.get('usage', {})
                             }
-                            
-                            merged_body = json.dumps(merged_response, ensure_ascii=False)
                     
-                    # Parse request_body as JSON if possible
+                    # Parse request body as JSON straight from bytes, else keep it as text
                     parsed_request_body = None
-                    if request_body:
+                    request_bytes = flow.request.content
+                    if request_bytes:
                         try:
-                            parsed_request_body = json.loads(request_body)
-                        except (json.JSONDecodeError, ValueError):
-                            parsed_request_body = request_body
+                            parsed_request_body = _json_loads(request_bytes)
+                        except ValueError:
+                            parsed_request_body = flow.request.get_text()
                     
-                    # Build request data with clean structure
-                    request_data = {
-                        'timestamp': datetime.fromtimestamp(flow.request.timestamp_start).isoformat() if flow.request and hasattr(flow.request, 'timestamp_start') else datetime.now().isoformat(),
-                        'request_body': parsed_request_body,
-                        'response': {}
-                    }
+                    timestamp = fromtimestamp(flow.request.timestamp_start).isoformat()
                     
                     # Original format
-                    flows_original.append({
-                        **request_data,
-                        'response': {
-                            'status_code': original_response['status_code'],
-                            'response_body': original_response['response_body'],
-                            'type': 'original'
-                        }
-                    })
+                    if out_original is not None:
+                        out_original.add({
+                            'timestamp': timestamp,
+                            'request_body': parsed_request_body,
+                            'response': {
+                                'status_code': original_response['status_code'],
+                                'response_body': original_response['response_body'],
+                                'type': 'original'
+                            }
+                        })
                     
                     # Merged format
-                    flows_merged.append({
-                        **request_data,
-                        'response': {
-                            **merged_response,
-                            'type': 'merged'
-                        }
-                    })
+                    if out_merged is not None:
+                        out_merged.add({
+                            'timestamp': timestamp,
+                            'request_body': parsed_request_body,
+                            'response': {
+                                **(merged_response or original_response),
+                                'type': 'merged'
+                            }
+                        })
+                    count += 1
     
     except Exception as e:
         print(f"❌ Error reading flows: {e}")
         return False
     
-    if not flows_original:
+    if not count:
         print(f"ℹ️  No flows found in {mitm_file}")
         return False
     
-    # Save both formats
-    base_name = mitm_file.replace('.mitm', '')
-    
-    # Original format
-    original_file = output_file or f"{base_name}_original.json"
-    merged_file = f"{base_name}_merged.json"
-    
-    # Ensure directories exist for output files
-    Path(original_file).parent.mkdir(parents=True, exist_ok=True)
-    Path(merged_file).parent.mkdir(parents=True, exist_ok=True)
-    
-    try:
-        # Save original (unmerged)
-        with open(original_file, 'w', encoding='utf-8') as f:
-            json.dump(flows_original, f, indent=2, ensure_ascii=False, default=str)
-        
-        # Save merged
-        with open(merged_file, 'w', encoding='utf-8') as f:
-            json.dump(flows_merged, f, indent=2, ensure_ascii=False, default=str)
-        
-        print(f"✅ Extracted {len(flows_original)} flows")
+    print(f"✅ Extracted {count} flows")
+    if write_original:
         print(f"   📄 Original: {original_file}")
+    if write_merged:
         print(f"   🔗 Merged: {merged_file}")
-        return True
-        
-    except Exception as e:
-        print(f"❌ Error writing JSON: {e}")
-        return False
+    return True
 
 
-def extract_from_both_locations():
+def extract_from_both_locations(pretty: bool = False, include_headers: bool = False,
+                                fmt: str = 'merged') -> bool:
     """Extract logs from local files and copy JSON to global locations"""
     from pathlib import Path
     
@@ -190,42 +320,43 @@ def extract_from_both_locations():
     mitm_files = list(local_logs_dir.glob("*.mitm"))
     if not mitm_files:
         mitm_files = [local_logs_dir / "cli_agent_requests.mitm"]
+    mitm_files = [mitm_file for mitm_file in mitm_files if mitm_file.exists()]
+    
+    # Create global directory based on current working directory path
+    global_logs_dir = derive_global_dir(os.getcwd())
+    if mitm_files:
+        global_logs_dir.mkdir(parents=True, exist_ok=True)
+        print(f"📁 Global JSON output: {global_logs_dir}")
     
     extracted_count = 0
     
-    for mitm_file in mitm_files:
-        if mitm_file.exists():
-            # Create global directory based on current working directory path
-            current_dir = Path.cwd()
-            # Create a safe directory name from the full path
-            dir_name = str(current_dir).replace('/', '-').replace(':', '-').replace(' ', '-')
-            global_logs_dir = Path.home() / ".claude" / "projects" / dir_name
-            global_logs_dir.mkdir(parents=True, exist_ok=True)
+    options = {'pretty': pretty, 'include_headers': include_headers, 'fmt': fmt}
+    for mitm_file, success, output in _extract_all(mitm_files, options):
+        print(f"🔄 Processing: {mitm_file}")
+        sys.stdout.write(output)
+        if success and fmt == 'original':
+            # Nothing merged to copy to the global directory
+            extracted_count += 1
+            print(f"✅ Extracted {mitm_file}")
+        elif success:
+            # Copy merged JSON file to global directory with timestamp
+            base_name = str(mitm_file).replace('.mitm', '')
             
-            print(f"🔄 Processing: {mitm_file}")
-            print(f"   📁 Global JSON output: {global_logs_dir}")
-            
-            # Extract JSON files to local directory first
-            success = extract_flows_to_json(str(mitm_file))
-            
-            if success:
-                # Copy merged JSON file to global directory with timestamp
-                from datetime import datetime
-                
-                base_name = str(mitm_file).replace('.mitm', '')
-                
-                merged_json_file = f"{base_name}_merged.json"
-                local_json = Path(merged_json_file)
-                if local_json.exists():
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    global_json = global_logs_dir / f"cli_agent_requests_{timestamp}.json"
-                    shutil.copy2(local_json, global_json)
-                    print(f"   • Copied merged JSON to global directory: {global_json}")
-                        
-                extracted_count += 1
-                print(f"✅ Extracted and copied to global directory")
-            else:
-                print(f"⚠️  Failed to extract")
+            merged_json_file = f"{base_name}_merged.json"
+            local_json = Path(merged_json_file)
+            if local_json.exists():
+                name = f"cli_agent_requests_{file_timestamp()}"
+                if len(mitm_files) > 1:
+                    # Parallel extractions can finish together; keep their copies apart
+                    name = f"{name}_{mitm_file.stem}"
+                global_json = global_logs_dir / f"{name}.json"
+                shutil.copy2(local_json, global_json)
+                print(f"   • Copied merged JSON to global directory: {global_json}")
+                    
+            extracted_count += 1
+            print(f"✅ Extracted {mitm_file} and copied to global directory")
+        else:
+            print(f"⚠️  Failed to extract {mitm_file}")
     
     if extracted_count == 0:
         print("❌ No mitm files found in local directory")
@@ -233,21 +364,70 @@ def extract_from_both_locations():
     
     return True
 
-def main():
+
+def _extract_captured(mitm_file: str, options: Dict[str, Any]) -> Tuple[bool, str]:
+    """Run extract_flows_to_json and return its result together with what it printed"""
+    buffer = StringIO()
+    with redirect_stdout(buffer):
+        try:
+            success = extract_flows_to_json(mitm_file, **options)
+        except Exception as e:
+            print(f"❌ Error extracting {mitm_file}: {e}")
+            success = False
+    return success, buffer.getvalue()
+
+
+def _extract_all(mitm_files: List[Path],
+                 options: Dict[str, Any]) -> Iterator[Tuple[Path, bool, str]]:
+    """Yield (mitm_file, success, output) for each file, extracting in parallel when there are several
+    
+    Each extraction's output is captured so the caller can print it under
+    that file's own heading instead of interleaved with the others.
+    """
+    if len(mitm_files) <= 1:
+        # Not worth the process pool startup cost
+        for mitm_file in mitm_files:
+            yield (mitm_file, *_extract_captured(str(mitm_file), options))
+        return
+    
+    workers = min(len(mitm_files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_extract_captured, str(mitm_file), options): mitm_file
+            for mitm_file in mitm_files
+        }
+        for future in as_completed(futures):
+            try:
+                success, output = future.result()
+            except Exception as e:
+                success, output = False, f"❌ Error extracting {futures[future]}: {e}\n"
+            yield futures[future], success, output
+
+
+def main() -> None:
     parser = argparse.ArgumentParser(description='Convert mitmweb flows to JSON')
     parser.add_argument('mitm_file', nargs='?', help='Path to .mitm flow file')
-    parser.add_argument('-o', '--output', help='Output JSON file')
+    parser.add_argument('-o', '--output', help='Output JSON file (the original one with --format both)')
     parser.add_argument('--all', action='store_true', help='Extract from both local and global locations')
+    parser.add_argument('--pretty', action='store_true', help='Indent JSON output for readability')
+    parser.add_argument('--include-headers', action='store_true', help='Keep response headers on unmerged responses')
+    parser.add_argument('--format', choices=['original', 'merged', 'both'], default='merged',
+                        help='Which JSON files to write (default: merged)')
     
     args = parser.parse_args()
     
     if args.all:
-        extract_from_both_locations()
+        extract_from_both_locations(pretty=args.pretty, include_headers=args.include_headers,
+                                    fmt=args.format)
     elif args.mitm_file:
-        extract_flows_to_json(args.mitm_file, args.output)
+        # -o names the file of the selected format
+        outputs = {'merged_output_file': args.output} if args.format == 'merged' else {'output_file': args.output}
+        extract_flows_to_json(args.mitm_file, pretty=args.pretty,
+                              include_headers=args.include_headers, fmt=args.format, **outputs)
     else:
         # Default behavior: check both locations
-        extract_from_both_locations()
+        extract_from_both_locations(pretty=args.pretty, include_headers=args.include_headers,
+                                    fmt=args.format)
 
 
 if __name__ == '__main__':
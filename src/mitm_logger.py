@@ -4,60 +4,81 @@ CLI Agent Logger using mitmweb for capturing API requests across any source
 """
 
 import os
+import shutil
 import sys
 import subprocess
 import signal
+import stat
 import time
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urlparse
 
+from ._util import derive_global_dir, emit, file_timestamp
+
+# Read size for the pre-3.8 file copy fallback (shutil itself uses 16 KiB there)
+_COPY_BUFSIZE = 1 << 20
+
+
+@lru_cache(maxsize=1)
+def _resolve_mitmweb():
+    """Absolute path of the mitmweb executable, or None when it isn't installed"""
+    return shutil.which("mitmweb")
+
+
+def _copy_file(src, dst):
+    """Copy file contents from src to dst without metadata"""
+    if sys.version_info >= (3, 8):
+        # Copies in-kernel (sendfile/fcopyfile) or with a 1 MiB readinto loop
+        shutil.copyfile(src, dst)
+        return
+    view = memoryview(bytearray(_COPY_BUFSIZE))
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            n = fsrc.readinto(view)
+            if not n:
+                break
+            fdst.write(view[:n])
+
 
 class MitmLogger:
-    def __init__(self, host="localhost", port=8000, logs_dir="cli-agent-logs", target_url="https://api.moonshot.cn", debug=False):
+    def __init__(self, host="localhost", port=8000, logs_dir="cli-agent-logs", target_url="https://api.moonshot.cn", debug=False, live_extract=False):
         self.host = host
         self.port = port
         self.logs_dir = Path(logs_dir)
         self.target_url = target_url
         self.debug = debug
+        self.live_extract = live_extract
         self.process = None
+        self.extract_thread = None
+        self.live_extract_ok = False
+        self._last_sync_sig = None
         self.local_logs_dir = Path(logs_dir)
+        self.stream_file = self.local_logs_dir / "cli_agent_requests.mitm"
         
         # Create global directory based on target URL
-        parsed_url = urlparse(target_url)
-        url_path = parsed_url.netloc.replace(':', '-').replace('/', '-')
-        self.global_logs_dir = Path.home() / ".claude" / "projects" / url_path
+        self.global_logs_dir = derive_global_dir(urlparse(target_url).netloc)
         
     def find_available_port(self, start_port=8000):
         """Find an available port starting from start_port"""
-        port = start_port
-        while port < start_port + 100:  # Try 100 ports max
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    result = s.connect_ex((self.host, port))
-                    if result != 0:  # Port is available
-                        return port
-                    port += 1
-            except Exception:
-                port += 1
+        # A successful bind proves the port is free without sending any traffic;
+        # a failed bind leaves the socket unbound, so it can be retried
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            for port in range(start_port, start_port + 100):  # Try 100 ports max
+                try:
+                    s.bind((self.host, port))
+                except OSError:
+                    continue
+                return port
         return None
         
     def setup_logs_directory(self):
         """Create logs directories for both local and global locations"""
-        # Create local logs directory (cwd)
-        self.local_logs_dir.mkdir(exist_ok=True)
-        
-        # Create global logs directory (~/.claude/projects/cli-agent-logs)
-        self.global_logs_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Create mitmweb configuration for both locations
-        for logs_dir in [self.local_logs_dir, self.global_logs_dir]:
-            config_dir = logs_dir / ".mitmproxy"
-            config_dir.mkdir(exist_ok=True)
-            
-            # Create custom mitmweb config
-            config_file = config_dir / "config.yaml"
-            config_content = f"""
+        config_content = f"""
 # Mitmproxy configuration for CLI Agent logging
 save_stream_file: cli_agent_requests.mitm
 web_host: {self.host}
@@ -70,12 +91,83 @@ proxy_debug: {'true' if self.debug else 'false'}
 web_debug: {'true' if self.debug else 'false'}
 termlog_verbosity: {'debug' if self.debug else 'info'}
 """
-            # Write the configuration file
-            with open(config_file, 'w') as f:
-                f.write(config_content.strip())
+        config_data = config_content.strip().encode('utf-8')
+        
+        def prepare(logs_dir):
+            # Creates the logs directory itself along with its .mitmproxy config dir
+            config_dir = logs_dir / ".mitmproxy"
+            config_dir.mkdir(parents=True, exist_ok=True)
+            self._write_if_changed(config_dir / "config.yaml", config_data)
+        
+        # Local (cwd) and global (~/.claude/projects/...) may sit on different
+        # mounts, so prepare both concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(prepare, [self.local_logs_dir, self.global_logs_dir]))
+        
+        self.setup_stream_file()
+    
+    @staticmethod
+    def _write_if_changed(path, data):
+        """Atomically replace path with data unless it already holds exactly that"""
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return
+        except FileNotFoundError:
+            pass
+        
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    def setup_stream_file(self):
+        """Make the stream file a FIFO for live extraction, or a regular file otherwise"""
+        try:
+            is_fifo = stat.S_ISFIFO(os.stat(self.stream_file).st_mode)
+        except FileNotFoundError:
+            is_fifo = None
+        
+        if self.live_extract:
+            if not is_fifo:
+                if is_fifo is False:
+                    # mitmweb truncates the previous capture on start anyway
+                    self.stream_file.unlink()
+                os.mkfifo(self.stream_file)
+        elif is_fifo:
+            # A leftover FIFO would block mitmweb with no reader attached
+            self.stream_file.unlink()
+    
+    def _run_live_extract(self, extract_flows_to_json):
+        """Extract flows from the FIFO as mitmweb writes them"""
+        self.live_extract_ok = extract_flows_to_json(str(self.stream_file))
+    
+    def _finish_live_extract(self):
+        """Wait for the live extraction thread to see EOF and finish"""
+        if self.process is None or self.process.poll() is None:
+            self.extract_thread.join(timeout=5)
+        # Once mitmweb has exited, no writer is coming; unblock the reader right away
+        if self.extract_thread.is_alive():
+            # mitmweb may never have opened the FIFO; connect and close a
+            # writer so the reader's open() returns and it sees EOF
+            try:
+                os.close(os.open(self.stream_file, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self.extract_thread.join()
+        self.extract_thread = None
         
     def start(self):
         """Start mitmweb logger with port conflict handling"""
+        # Report a missing install before touching the filesystem or spawning anything
+        mitmweb = _resolve_mitmweb()
+        if mitmweb is None:
+            emit([
+                "❌ mitmweb not found. Please install mitmproxy:",
+                "   pip install mitmproxy",
+            ])
+            return None
+        
         self.setup_logs_directory()
         
         # Check if port is available
@@ -90,27 +182,33 @@ termlog_verbosity: {'debug' if self.debug else 'info'}
             print(f"⚠️  Port {self.port} is occupied, using port {available_port} instead")
             self.port = available_port
         
-        print(f"🚀 Starting CLI Agent Logger with mitmweb...")
-        print(f"   Proxy: http://localhost:{self.port}")
-        print(f"   Web UI: http://localhost:{self.port + 1000}")
-        print(f"   Target: {self.target_url}")
-        print(f"   Local Logs: {self.local_logs_dir}/")
-        print(f"   Global Logs: {self.global_logs_dir}/")
-        print("")
-        print("Configure your client to use:")
-        print(f"  Base URL: http://localhost:{self.port}")
-        print("")
+        emit([
+            "🚀 Starting CLI Agent Logger with mitmweb...",
+            f"   Proxy: http://localhost:{self.port}",
+            f"   Web UI: http://localhost:{self.port + 1000}",
+            f"   Target: {self.target_url}",
+            f"   Local Logs: {self.local_logs_dir}/",
+            f"   Global Logs: {self.global_logs_dir}/",
+            "",
+            "Configure your client to use:",
+            f"  Base URL: http://localhost:{self.port}",
+            "",
+        ])
         
-        # Start mitmweb with correct working directory (using local logs dir by default)
+        # Start mitmweb with an absolute executable and stream file path: with no cwd
+        # and close_fds=False, Popen can use posix_spawn instead of fork + exec
         try:
             cmd = [
-                "mitmweb",
+                mitmweb,
                 "--mode", f"reverse:{self.target_url}",
                 "--listen-port", str(self.port),
                 "--web-host", self.host,
                 "--web-port", str(self.port + 1000),
-                "--set", f"save_stream_file=cli_agent_requests.mitm",
-                "--set", "stream_large_bodies=100m",
+                "--set", f"save_stream_file={self.stream_file.resolve()}",
+                # Bodies above this are streamed through instead of buffered (avoids
+                # mitmproxy's quadratic buffer slicing on huge payloads) but are then
+                # not saved to the stream file. 32m matches the API request size cap.
+                "--set", "stream_large_bodies=32m",
                 "--set", "body_size_limit=500m",
                 "--set", "connection_timeout=600",
                 "--set", "read_timeout=600",
@@ -140,13 +238,14 @@ termlog_verbosity: {'debug' if self.debug else 'info'}
                 env = os.environ.copy()
                 env['MITMPROXY_DEBUG'] = '1'
                 
-                # Use shell to redirect both stdout and stderr
-                cmd_str = ' '.join(f'"{arg}"' for arg in cmd) + f' >"{debug_log_file}" 2>&1'
+                # Use shell to redirect both stdout and stderr; exec so the shell is
+                # replaced by mitmweb and stop() signals mitmweb itself
+                cmd_str = 'exec ' + ' '.join(f'"{arg}"' for arg in cmd) + f' >"{debug_log_file}" 2>&1'
                 self.process = subprocess.Popen(
                     cmd_str,
                     shell=True,
                     env=env,
-                    cwd=self.local_logs_dir,
+                    close_fds=False,
                     stdout=subprocess.DEVNULL,
                     stderr=subprocess.DEVNULL
                 )
@@ -154,15 +253,31 @@ termlog_verbosity: {'debug' if self.debug else 'info'}
             else:
                 self.process = subprocess.Popen(
                     cmd,
+                    close_fds=False,
                     stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    cwd=self.local_logs_dir
+                    stderr=subprocess.DEVNULL
+                )
+            
+            if self.live_extract:
+                # Imported here on the calling thread: a caller that returns right
+                # after start() leaves the thread running during interpreter
+                # shutdown, when the import can no longer register its atexit hooks
+                from .extract_logs import extract_flows_to_json
+                
+                # Flows go straight from mitmweb through the FIFO into JSON
+                self.extract_thread = threading.Thread(
+                    target=self._run_live_extract,
+                    args=(extract_flows_to_json,),
+                    name="live-extract"
                 )
+                self.extract_thread.start()
             
-            print("✅ Logger started successfully!")
-            print("📁 Logs will be saved to both local and global locations")
-            print(f"   • Local: {self.local_logs_dir}/cli_agent_requests.mitm")
-            print(f"   • Global: {self.global_logs_dir}/cli_agent_requests.mitm")
+            emit([
+                "✅ Logger started successfully!",
+                "📁 Logs will be saved to both local and global locations",
+                f"   • Local: {self.local_logs_dir}/cli_agent_requests.mitm",
+                f"   • Global: {self.global_logs_dir}/cli_agent_requests.mitm",
+            ])
             
             # Don't wait - let caller control lifecycle
             return self.process
@@ -178,13 +293,17 @@ termlog_verbosity: {'debug' if self.debug else 'info'}
     def stop(self):
         """Stop mitmweb logger"""
         if self.process:
-            self.process.terminate()
+            # SIGTERM lets mitmweb flush the stream file; wait() returns as soon
+            # as it exits, and a hung instance is killed after 2 seconds
+            self.process.send_signal(signal.SIGTERM)
             try:
-                self.process.wait(timeout=5)
+                self.process.wait(timeout=2)
             except subprocess.TimeoutExpired:
-                self.process.kill()
+                self.process.send_signal(signal.SIGKILL)
                 self.process.wait()
         
+        if self.extract_thread:
+            self._finish_live_extract()
         
         # Copy logs to global location when stopping
         self._sync_logs_to_global()
@@ -195,39 +314,73 @@ termlog_verbosity: {'debug' if self.debug else 'info'}
         """Copy JSON files to global directory based on working directory path"""
         try:
             from .extract_logs import extract_flows_to_json
-            import shutil
             
             # Create global directory based on current working directory path
-            current_dir = Path.cwd()
-            dir_name = str(current_dir).replace('/', '-').replace(':', '-').replace(' ', '-')
-            global_logs_dir = Path.home() / ".claude" / "projects" / dir_name
+            global_logs_dir = derive_global_dir(os.getcwd())
             global_logs_dir.mkdir(parents=True, exist_ok=True)
             
+            # Merged JSON goes to global directory with timestamp
+            global_json = global_logs_dir / f"cli_agent_requests_{file_timestamp()}.json"
+            
             # Extract JSON files to local directory first
-            local_mitm = self.local_logs_dir / "cli_agent_requests.mitm"
-            if local_mitm.exists():
-                print(f"   • Extracting JSON files to local directory")
-                success = extract_flows_to_json(str(local_mitm))
-                
-                if success:
-                    # Copy merged JSON file to global directory with timestamp
-                    from datetime import datetime
-                    
-                    base_name = str(local_mitm).replace('.mitm', '')
-                    merged_json_file = f"{base_name}_merged.json"
-                    
-                    local_json = Path(merged_json_file)
-                    if local_json.exists():
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        global_json = global_logs_dir / f"cli_agent_requests_{timestamp}.json"
-                        shutil.copy2(local_json, global_json)
-                        print(f"   • Copied merged JSON to global directory: {global_json}")
+            local_mitm = self.stream_file
+            try:
+                # One stat answers both "is there a capture" and "has it changed"
+                st = None if self.live_extract else os.stat(local_mitm)
+            except FileNotFoundError:
+                st = None
+            
+            copied = False
+            if self.live_extract:
+                # Already extracted from the FIFO while mitmweb ran;
+                # opening it again here would block with no writer
+                success = self.live_extract_ok
+            elif st is not None:
+                sig = (st.st_mtime_ns, st.st_size)
+                if sig == self._last_sync_sig:
+                    # Capture untouched since the last sync; its JSON is current
+                    print(f"   • Capture unchanged, reusing extracted JSON files")
+                    success = True
+                else:
+                    print(f"   • Extracting JSON files to local directory")
+                    # The global copy is written alongside the local file in the same pass
+                    success = extract_flows_to_json(str(local_mitm), merged_copies=[str(global_json)])
+                    copied = success
+                    if success:
+                        self._last_sync_sig = sig
             else:
                 print(f"   ⚠️  No mitm file found: {local_mitm}")
+                success = False
+            
+            if success and not copied:
+                base_name = str(local_mitm).replace('.mitm', '')
+                local_json = Path(f"{base_name}_merged.json")
+                try:
+                    # Metadata isn't needed; the timestamp is in the file name.
+                    # Opening the source doubles as the existence check
+                    _copy_file(local_json, global_json)
+                    copied = True
+                except FileNotFoundError:
+                    pass
+            
+            if copied:
+                print(f"   • Copied merged JSON to global directory: {global_json}")
                     
         except Exception as e:
             print(f"   ⚠️  Failed to generate global JSON files: {e}")
     
+    def run(self):
+        """Start mitmweb, wait for it to exit (or Ctrl+C), then stop and sync logs"""
+        if self.start() is None:
+            return False
+        try:
+            self.process.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        return True
+    
     def get_log_locations(self):
         """Get both local and global log locations"""
         return {
@@ -245,11 +398,17 @@ def main():
     parser.add_argument('--logs-dir', '-d', default='logs', help='Directory to save logs')
     parser.add_argument('--target', '-t', default='https://api.moonshot.cn', help='Target API URL to proxy')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode with verbose logging')
+    parser.add_argument('--live-extract', action='store_true', help='Stream flows through a FIFO into JSON instead of a .mitm file')
     
     args = parser.parse_args()
 
-    logger = MitmLogger(host=args.host, port=args.port, logs_dir=args.logs_dir, target_url=args.target, debug=args.debug)
-    logger.start()
+    logger = MitmLogger(host=args.host, port=args.port, logs_dir=args.logs_dir, target_url=args.target, debug=args.debug, live_extract=args.live_extract)
+    if args.live_extract:
+        # The FIFO's reader lives in this process, so stay up until mitmweb exits
+        if not logger.run():
+            sys.exit(1)
+    else:
+        logger.start()
 
 
 if __name__ == '__main__':
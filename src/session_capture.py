@@ -0,0 +1,45 @@
+"""
+mitmweb addon giving each session attached to a persistent logger its own capture
+
+Loaded with -s, so it must not import from this package. A session marks its
+requests by sending them under /_session/<id>/; the prefix is stripped before
+the request is forwarded, and the flow is appended to sessions/<id>.mitm
+(relative to the logger's working directory, its logs directory).
+"""
+
+import os
+import re
+
+from mitmproxy import http, io
+
+SESSION_PREFIX = "/_session/"
+SESSIONS_DIR = "sessions"
+
+_SESSION_PATH = re.compile(r"^/_session/([A-Za-z0-9_-]+)(/.*)?$", re.DOTALL)
+
+
+class SessionCapture:
+    def request(self, flow: http.HTTPFlow) -> None:
+        match = _SESSION_PATH.match(flow.request.path)
+        if match:
+            flow.metadata["cli_agent_session"] = match.group(1)
+            flow.request.path = match.group(2) or "/"
+
+    def response(self, flow: http.HTTPFlow) -> None:
+        self._write(flow)
+
+    def error(self, flow: http.HTTPFlow) -> None:
+        self._write(flow)
+
+    def _write(self, flow: http.HTTPFlow) -> None:
+        session = flow.metadata.get("cli_agent_session")
+        if session is None:
+            return
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        # Opened per flow and closed right away: the session extracts this file
+        # while the logger keeps running, so nothing may sit in a write buffer
+        with open(os.path.join(SESSIONS_DIR, f"{session}.mitm"), "ab") as f:
+            io.FlowWriter(f).add(flow)
+
+
+addons = [SessionCapture()]